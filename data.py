@@ -9,6 +9,7 @@ Futtatás:
     python data.py init
     python data.py query
     python data.py query "Kérdés"
+    python data.py query --session
 
 Előfeltételek (pip):
     pip install psycopg2-binary pgvector sentence-transformers tiktoken requests numpy
@@ -61,7 +62,7 @@ class Config:
         "http://localhost:11434/api/chat",
     )
     ollama_model: str = os.getenv("OLLAMA_MODEL", "llama3.2:3b")
-
+    ollama_keep_alive: str = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # KV cache életben tartása session módban
 
 
     # Chunk / retrieval
@@ -80,6 +81,8 @@ class Config:
     # Futtatás
     debug: bool = False
     no_stream: bool = False
+    session: bool = False
+    session_followups: int = int(os.getenv("SESSION_FOLLOWUPS", "2"))  # ennyi követő körnek hagyunk helyet
 
 
 # ----------------------------------------------------------------------
@@ -467,7 +470,9 @@ def build_context_for_tickets(
     ticket_ids: List[int],
     top_k: int,
     cfg: Config,
+    reserve_for_answer: Optional[int] = None,
 ) -> str:
+    reserve = cfg.reserve_for_answer if reserve_for_answer is None else reserve_for_answer
     blocks: List[str] = []
     for tid in ticket_ids:
         chunks_scored = retrieve_chunks_for_ticket(conn, q_emb, tid, top_k=top_k)
@@ -484,7 +489,7 @@ def build_context_for_tickets(
     # token budget szerint összepakoljuk a végső contextet
     header = "KONTEKSTUS:\n"
     combined = "\n\n====================\n\n".join(blocks)
-    if token_len(header + combined) <= cfg.model_max_context - cfg.reserve_for_answer:
+    if token_len(header + combined) <= cfg.model_max_context - reserve:
         return combined
 
     # ha túl hosszú, blokk szinten vágunk
@@ -495,18 +500,62 @@ def build_context_for_tickets(
         else:
             candidate = "\n\n====================\n\n".join(final_parts + [b])
 
-        if token_len(header + candidate) <= cfg.model_max_context - cfg.reserve_for_answer:
+        if token_len(header + candidate) <= cfg.model_max_context - reserve:
             final_parts.append(b)
         else:
             break
 
     # ha még így is túl hosszú (ritka), akkor chunk szintű vágás
     if not final_parts:
-        return pack_chunks_by_token_budget(header, [blocks[0]], cfg.model_max_context, cfg.reserve_for_answer)
+        return pack_chunks_by_token_budget(header, [blocks[0]], cfg.model_max_context, reserve)
 
     return "\n\n====================\n\n".join(final_parts)
 
 
+NO_CONTEXT_ANSWER = "Nem találtam releváns kontextust az adatbázisban."
+
+
+def select_tickets(
+    conn,
+    question: str,
+    embedder: SentenceTransformer,
+    cfg: Config,
+) -> Tuple[List[int], List[float]]:
+    ticket_ids, q_emb = retrieve_top_ticket_ids(
+        conn,
+        question,
+        embedder,
+        candidate_k=cfg.candidate_k,
+        top_tickets=cfg.top_tickets,
+    )
+
+    if cfg.debug:
+        print(f"\n--- TOP TICKETS: {ticket_ids} ---")
+
+    return ticket_ids, q_emb
+
+
+def print_context_preview(context: str) -> None:
+    print("\n--- CONTEXT PREVIEW ---")
+    print(context[:900])
+    print("\n--- END ---\n")
+
+
+def prepare_context(
+    conn,
+    q_emb: List[float],
+    ticket_ids: List[int],
+    cfg: Config,
+    reserve_for_answer: Optional[int] = None,
+) -> str:
+    context = build_context_for_tickets(
+        conn, q_emb, ticket_ids, top_k=cfg.top_k, cfg=cfg, reserve_for_answer=reserve_for_answer
+    )
+    if context and cfg.debug:
+        print_context_preview(context)
+    return context
+
+
 # ----------------------------------------------------------------------
 # Prompt + Ollama chat
 # ----------------------------------------------------------------------
@@ -555,6 +604,179 @@ def ollama_chat(system: str, user: str, cfg: Config) -> str:
     return (msg.get("content") or "").strip()
 
 
+# ----------------------------------------------------------------------
+# Session mód: Ollama /api/generate + visszaadott context (KV) újrahasznosítás
+# ----------------------------------------------------------------------
+# A tiktoken és a modell tokenizere eltér, a követő kör körüli template
+# tokeneket pedig nem látjuk előre – ezért bővített ráhagyással számolunk.
+SESSION_TOKEN_SLACK = 1.25
+SESSION_TEMPLATE_TOKENS = 64
+SESSION_QUESTION_TOKENS = 64  # tipikus követő kérdés hossza a budget tervezéshez
+
+
+def session_followup_tokens(question: str) -> int:
+    """Egy követő kör promptjának becsült mérete (system + kérdés + template)."""
+    return int(token_len(SYSTEM_PROMPT + question) * SESSION_TOKEN_SLACK) + SESSION_TEMPLATE_TOKENS
+
+
+def session_context_reserve(cfg: Config) -> int:
+    """
+    Az 1. kör KONTEKSTUS-ának tartaléka session módban: a saját system
+    prompt és válasz mellett `cfg.session_followups` követő körnek
+    (prompt + válasz) is helyet hagy a `num_ctx` ablakban.
+    """
+    turn = session_followup_tokens("") + SESSION_QUESTION_TOKENS + cfg.reserve_for_answer
+    return session_followup_tokens("") + cfg.reserve_for_answer + cfg.session_followups * turn
+
+
+@dataclass
+class ChatSession:
+    """
+    Egy beszélgetés állapota. Amíg a top ticketek nem változnak, a prefix
+    (system + KONTEKSTUS) változatlan, és az Ollama által visszaadott
+    `context` tokenekből folytatjuk, így a prefixet nem kell újra kiértékelni.
+    """
+    ticket_ids: Optional[List[int]] = None
+    context: str = ""
+    kv_context: Optional[List[int]] = None
+    # az 1. kör prompt tokenjei (system + KONTEKSTUS + kérdés)
+    prefix_tokens: int = 0
+    # ns/token az első kör alapján; None, ha nem mérhető (pl. Ollama prompt cache)
+    ns_per_token: Optional[float] = None
+
+    def reset(self) -> None:
+        self.ticket_ids = None
+        self.context = ""
+        self.kv_context = None
+        self.prefix_tokens = 0
+        self.ns_per_token = None
+
+
+def build_followup_prompt(question: str) -> str:
+    return f"KÉRDÉS: {question}"
+
+
+def ollama_generate(
+    prompt: str,
+    cfg: Config,
+    system: Optional[str] = None,
+    context: Optional[List[int]] = None,
+) -> Dict[str, Any]:
+    """
+    Nem-streamelt /api/generate hívás. A teljes választ adja vissza, benne a
+    `context` tokenlistával és a `prompt_eval_*` mérőszámokkal.
+
+    A `num_ctx` a `cfg.model_max_context`, hogy az Ollama ne csonkolja
+    csendben a felhalmozott contextet egy kisebb alapértelmezett ablakra.
+    """
+    payload: Dict[str, Any] = {
+        "model": cfg.ollama_model,
+        "prompt": prompt,
+        "stream": False,
+        "keep_alive": cfg.ollama_keep_alive,
+        "options": {
+            "temperature": 0.0,
+            "num_predict": 256,
+            "num_ctx": cfg.model_max_context,
+            "stop": ["\n\nKONTEKSTUS", "\nKÉRDÉS:", "Szabályok:", "Feladat:"]
+        },
+    }
+    if system is not None:
+        payload["system"] = system
+    if context:
+        payload["context"] = context
+
+    resp = requests.post(cfg.ollama_generate_endpoint, json=payload, timeout=120)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def session_answer(
+    session: ChatSession,
+    conn,
+    question: str,
+    embedder: SentenceTransformer,
+    cfg: Config,
+) -> str:
+    """
+    Egy kör session módban. A követő körök is megkapják a `SYSTEM_PROMPT`-ot:
+    az /api/generate minden hívásnál lerendereli a template-et, system nélkül
+    a modell alapértelmezett system blokkja kerülne be, és elvesznének a
+    kimeneti szabályok. Ez körönként kb. 100 token, a KONTEKSTUS-t továbbra
+    sem értékeli újra.
+    """
+    ticket_ids, q_emb = select_tickets(conn, question, embedder, cfg)
+
+    # a követő kör (system + kérdés + template + válasz) is férjen az ablakba
+    kv_len = len(session.kv_context or [])
+    same_tickets = session.kv_context is not None and ticket_ids == session.ticket_ids
+    fits = kv_len + session_followup_tokens(question) + cfg.reserve_for_answer <= cfg.model_max_context
+    reuse = same_tickets and fits
+
+    if reuse:
+        log.debug("Session: azonos ticketek (%s), chunk retrieval és prefix kihagyva.", ticket_ids)
+        if cfg.debug:
+            print_context_preview(session.context)
+        data = ollama_generate(
+            build_followup_prompt(question),
+            cfg,
+            system=SYSTEM_PROMPT,
+            context=session.kv_context,
+        )
+    else:
+        if session.kv_context is None:
+            log.info("Session: új kontextus (tickets: %s).", ticket_ids)
+        elif not same_tickets:
+            log.info("Session reset: ticketek változtak (%s -> %s).", session.ticket_ids, ticket_ids)
+        else:
+            log.info(
+                "Session reset: a context nem fér az ablakba (%d token, num_ctx=%d).",
+                kv_len, cfg.model_max_context,
+            )
+
+        session.reset()
+        context = prepare_context(
+            conn, q_emb, ticket_ids, cfg, reserve_for_answer=session_context_reserve(cfg)
+        )
+        if not context:
+            return NO_CONTEXT_ANSWER
+
+        # stabil prefix sorrend: system -> KONTEKSTUS -> KÉRDÉS
+        data = ollama_generate(build_user_prompt(question, context), cfg, system=SYSTEM_PROMPT)
+        session.ticket_ids = ticket_ids
+        session.context = context
+
+        # csak akkor mérünk sebességet, ha a teljes prompt ki lett értékelve;
+        # ha az Ollama saját prompt cache-e kiszolgált egy részt, nem becsülünk
+        eval_count = int(data.get("prompt_eval_count") or 0)
+        eval_ns = int(data.get("prompt_eval_duration") or 0)
+        prompt_tokens = len(data.get("context") or []) - int(data.get("eval_count") or 0)
+        session.prefix_tokens = max(prompt_tokens, eval_count)
+        if eval_count and eval_ns and eval_count >= prompt_tokens:
+            session.ns_per_token = eval_ns / eval_count
+
+    session.kv_context = data.get("context") or None
+
+    eval_count = int(data.get("prompt_eval_count") or 0)
+    eval_ms = int(data.get("prompt_eval_duration") or 0) / 1e6
+    if reuse and session.ns_per_token:
+        # durva becslés a stateless úthoz képest: az /api/chat minden körben
+        # system + KONTEKSTUS + az aktuális kérdés promptot értékelné ki, ami
+        # kb. az 1. kör prompt mérete, plusz a most kiértékelt követő prompt
+        full_ms = session.ns_per_token * (session.prefix_tokens + eval_count) / 1e6
+        log.info(
+            "Prompt eval: %d token, %.0f ms (becsült megtakarítás a stateless úthoz képest: ~%.0f ms)",
+            eval_count, eval_ms, max(0.0, full_ms - eval_ms),
+        )
+    elif reuse:
+        log.info("Prompt eval: %d token, %.0f ms (KV újrahasznosítva, megtakarítás nem becsülhető)",
+                 eval_count, eval_ms)
+    else:
+        log.info("Prompt eval: %d token, %.0f ms (teljes prefix)", eval_count, eval_ms)
+
+    return (data.get("response") or "").strip()
+
+
 # ----------------------------------------------------------------------
 # CLI
 # ----------------------------------------------------------------------
@@ -574,33 +796,21 @@ def cli_init(args: argparse.Namespace) -> None:
 
 
 def cli_query(args: argparse.Namespace) -> None:
-    cfg = Config(debug=args.debug, no_stream=args.no_stream)
+    cfg = Config(debug=args.debug, no_stream=args.no_stream, session=args.session)
     configure_logging(cfg.debug)
 
     conn = get_connection(cfg.pg_dsn)
     embedder = load_embedder(cfg.embed_model)
+    session = ChatSession()
 
     def answer_one(question: str) -> str:
-        ticket_ids, q_emb = retrieve_top_ticket_ids(
-            conn,
-            question,
-            embedder,
-            candidate_k=cfg.candidate_k,
-            top_tickets=cfg.top_tickets,
-        )
+        if cfg.session:
+            return session_answer(session, conn, question, embedder, cfg)
 
-        if cfg.debug:
-            print(f"\n--- TOP TICKETS: {ticket_ids} ---")
-
-        context = build_context_for_tickets(conn, q_emb, ticket_ids, top_k=cfg.top_k, cfg=cfg)
+        ticket_ids, q_emb = select_tickets(conn, question, embedder, cfg)
+        context = prepare_context(conn, q_emb, ticket_ids, cfg)
         if not context:
-            return "Nem találtam releváns kontextust az adatbázisban."
-
-        if cfg.debug:
-            preview = context[:900]
-            print("\n--- CONTEXT PREVIEW ---")
-            print(preview)
-            print("\n--- END ---\n")
+            return NO_CONTEXT_ANSWER
 
         user_prompt = build_user_prompt(question, context)
         return ollama_chat(SYSTEM_PROMPT, user_prompt, cfg)
@@ -644,6 +854,11 @@ def main() -> None:
     p_query = sub.add_parser("query", help="Interaktív kérdező vagy egyetlen kérdés")
     p_query.add_argument("--debug", action="store_true")
     p_query.add_argument("--no-stream", action="store_true")
+    p_query.add_argument(
+        "--session",
+        action="store_true",
+        help="Beszélgetős mód: azonos ticketeknél a kontextus (Ollama KV) újrahasznosítása.",
+    )
     p_query.add_argument("question", nargs="?", help="Ha megadod: egyszeri kérdés. Ha üres: interaktív mód.")
     p_query.set_defaults(func=cli_query)
 